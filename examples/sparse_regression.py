@@ -29,9 +29,11 @@ import time
 import numpy as np
 
 import jax
-from jax import vmap
+from jax import jit, lax, vmap
 import jax.numpy as jnp
 import jax.random as random
+from jax.scipy.linalg import cho_factor, cho_solve
+from jax.tree_util import tree_map, tree_multimap
 
 import numpyro
 import numpyro.distributions as dist
@@ -39,20 +41,48 @@ from numpyro.infer import MCMC, NUTS
 
 
 def dot(X, Z):
-    return jnp.dot(X, Z[..., None])[..., 0]
+    return jnp.matmul(X, jnp.swapaxes(Z, -1, -2))
+
+
+# Apply `vmap(fn)` to `array` in chunks of size `chunk_size` along the leading axis.
+# The chunks are evaluated with a single `lax.map` (i.e. one compiled scan) so that
+# peak memory stays proportional to `chunk_size` rather than to `array.shape[0]`,
+# without incurring a Python-level dispatch per chunk.
+def chunk_vmap(fn, array, chunk_size=10):
+    L = array.shape[0]
+    # a single outer jit around the vmapped function lets XLA fuse the whole
+    # per-chunk computation into one dispatch instead of op-by-op evaluation
+    vmapped_fn = jit(vmap(fn))
+    if chunk_size >= L:
+        return vmapped_fn(array)
+    num_chunks = L // chunk_size
+    head = array[:num_chunks * chunk_size].reshape((num_chunks, chunk_size) + array.shape[1:])
+    results = lax.map(vmapped_fn, head)
+    results = tree_map(lambda x: jnp.reshape(x, (num_chunks * chunk_size,) + x.shape[2:]), results)
+    if L % chunk_size == 0:
+        return results
+    tail_results = vmapped_fn(array[num_chunks * chunk_size:])
+    return tree_multimap(lambda x, y: jnp.concatenate([x, y]), results, tail_results)
 
 
 # The kernel that corresponds to our quadratic regressor.
 def kernel(X, Z, eta1, eta2, c, jitter=1.0e-6):
     eta1sq = jnp.square(eta1)
     eta2sq = jnp.square(eta2)
-    k1 = 0.5 * eta2sq * jnp.square(1.0 + dot(X, Z))
-    k2 = -0.5 * eta2sq * dot(jnp.square(X), jnp.square(Z))
-    k3 = (eta1sq - eta2sq) * dot(X, Z)
-    k4 = jnp.square(c) - 0.5 * eta2sq
+    xz = dot(X, Z)
+    Xsq = jnp.square(X)
+    # reuse the squared inputs when the kernel is evaluated at (X, X)
+    Zsq = Xsq if Z is X else jnp.square(Z)
+    # expanding the square term 0.5 * eta2^2 * (1 + xz)^2 and collecting
+    # coefficients collapses the four kernel terms to
+    #   k = 0.5 * eta2^2 * (xz^2 - <X^2, Z^2>) + eta1^2 * xz + c^2
+    # which avoids materializing 1 + xz and the intermediate k1..k4 terms
+    k = 0.5 * eta2sq * (jnp.square(xz) - dot(Xsq, Zsq)) + eta1sq * xz + jnp.square(c)
     if X.shape == Z.shape:
-        k4 += jitter * jnp.eye(X.shape[0])
-    return k1 + k2 + k3 + k4
+        # add the jitter to the diagonal directly instead of materializing
+        # a dense jitter * I matrix
+        k = jax.ops.index_add(k, jnp.diag_indices(X.shape[0]), jitter)
+    return k
 
 
 # Most of the model code is concerned with constructing the sparsity inducing prior.
@@ -76,7 +106,11 @@ def model(X, Y, hypers):
 
     # compute kernel
     kX = kappa * X
-    k = kernel(kX, kX, eta1, eta2, hypers['c']) + var_obs * jnp.eye(N)
+    # checkpoint the kernel evaluation so that its O(N^2) intermediates are
+    # rematerialized in the backward pass instead of being stored across every
+    # leapfrog step during HMC
+    k = jax.remat(kernel)(kX, kX, eta1, eta2, hypers['c'])
+    k = jax.ops.index_add(k, jnp.diag_indices(N), var_obs)
     assert k.shape == (N, N)
 
     # sample Y according to the standard gaussian process formula
@@ -99,16 +133,25 @@ def compute_singleton_mean_variance(X, Y, dimension, msq, lam, eta1, xisq, c, va
     kX = kappa * X
     kprobe = kappa * probe
 
-    k_xx = kernel(kX, kX, eta1, eta2, c) + var_obs * jnp.eye(N)
-    k_xx_inv = jnp.linalg.inv(k_xx)
-    k_probeX = kernel(kprobe, kX, eta1, eta2, c)
-    k_prbprb = kernel(kprobe, kprobe, eta1, eta2, c)
+    # evaluate the kernel once on the stacked probe/training inputs and read off
+    # the three blocks we need, sharing the Gram computation between them
+    joint = jnp.concatenate([kprobe, kX])
+    k_joint = kernel(joint, joint, eta1, eta2, c)
+    k_prbprb = k_joint[:2, :2]
+    k_probeX = k_joint[:2, 2:]
+    k_xx = jax.ops.index_add(k_joint[2:, 2:], jnp.diag_indices(N), var_obs)
+    # k_xx is symmetric positive definite, so solve against its Cholesky
+    # factor instead of forming the dense inverse
+    k_xx_cho = cho_factor(k_xx, lower=True)
 
     vec = jnp.array([0.50, -0.50])
-    mu = jnp.matmul(k_probeX, jnp.matmul(k_xx_inv, Y))
+    # the solve against k_probeX^T serves both the mean (via its transpose)
+    # and the variance
+    S = cho_solve(k_xx_cho, jnp.transpose(k_probeX))
+    mu = jnp.matmul(jnp.transpose(S), Y)
     mu = jnp.dot(mu, vec)
 
-    var = k_prbprb - jnp.matmul(k_probeX, jnp.matmul(k_xx_inv, jnp.transpose(k_probeX)))
+    var = k_prbprb - jnp.matmul(k_probeX, S)
     var = jnp.matmul(var, vec)
     var = jnp.dot(var, vec)
 
@@ -130,16 +173,23 @@ def compute_pairwise_mean_variance(X, Y, dim1, dim2, msq, lam, eta1, xisq, c, va
     kX = kappa * X
     kprobe = kappa * probe
 
-    k_xx = kernel(kX, kX, eta1, eta2, c) + var_obs * jnp.eye(N)
-    k_xx_inv = jnp.linalg.inv(k_xx)
-    k_probeX = kernel(kprobe, kX, eta1, eta2, c)
-    k_prbprb = kernel(kprobe, kprobe, eta1, eta2, c)
+    # as in compute_singleton_mean_variance, share the Gram computation between
+    # the three kernel blocks
+    joint = jnp.concatenate([kprobe, kX])
+    k_joint = kernel(joint, joint, eta1, eta2, c)
+    k_prbprb = k_joint[:4, :4]
+    k_probeX = k_joint[:4, 4:]
+    k_xx = jax.ops.index_add(k_joint[4:, 4:], jnp.diag_indices(N), var_obs)
+    # as above, solve against the Cholesky factor of k_xx and reuse the solve
+    # for both the mean and the variance
+    k_xx_cho = cho_factor(k_xx, lower=True)
 
     vec = jnp.array([0.25, -0.25, -0.25, 0.25])
-    mu = jnp.matmul(k_probeX, jnp.matmul(k_xx_inv, Y))
+    S = cho_solve(k_xx_cho, jnp.transpose(k_probeX))
+    mu = jnp.matmul(jnp.transpose(S), Y)
     mu = jnp.dot(mu, vec)
 
-    var = k_prbprb - jnp.matmul(k_probeX, jnp.matmul(k_xx_inv, jnp.transpose(k_probeX)))
+    var = k_prbprb - jnp.matmul(k_probeX, S)
     var = jnp.matmul(var, vec)
     var = jnp.dot(var, vec)
 
@@ -155,14 +205,17 @@ def sample_theta_space(X, Y, active_dims, msq, lam, eta1, xisq, c, var_obs):
     # the total number of coefficients we return
     num_coefficients = P + M * (M - 1) // 2
 
-    probe = jnp.zeros((2 * P + 2 * M * (M - 1), P))
-    vec = jnp.zeros((num_coefficients, 2 * P + 2 * M * (M - 1)))
+    # the probe and vec matrices only depend on the concrete active_dims, so we
+    # build them on the host with numpy (a single device transfer when they are
+    # first used) instead of issuing one index_update op per coefficient.
+    probe = np.zeros((2 * P + 2 * M * (M - 1), P))
+    vec = np.zeros((num_coefficients, 2 * P + 2 * M * (M - 1)))
     start1 = 0
     start2 = 0
 
     for dim in range(P):
-        probe = jax.ops.index_update(probe, jax.ops.index[start1:start1 + 2, dim], jnp.array([1.0, -1.0]))
-        vec = jax.ops.index_update(vec, jax.ops.index[start2, start1:start1 + 2], jnp.array([0.5, -0.5]))
+        probe[start1:start1 + 2, dim] = [1.0, -1.0]
+        vec[start2, start1:start1 + 2] = [0.5, -0.5]
         start1 += 2
         start2 += 1
 
@@ -170,12 +223,9 @@ def sample_theta_space(X, Y, active_dims, msq, lam, eta1, xisq, c, var_obs):
         for dim2 in active_dims:
             if dim1 >= dim2:
                 continue
-            probe = jax.ops.index_update(probe, jax.ops.index[start1:start1 + 4, dim1],
-                                         jnp.array([1.0, 1.0, -1.0, -1.0]))
-            probe = jax.ops.index_update(probe, jax.ops.index[start1:start1 + 4, dim2],
-                                         jnp.array([1.0, -1.0, 1.0, -1.0]))
-            vec = jax.ops.index_update(vec, jax.ops.index[start2, start1:start1 + 4],
-                                       jnp.array([0.25, -0.25, -0.25, 0.25]))
+            probe[start1:start1 + 4, dim1] = [1.0, 1.0, -1.0, -1.0]
+            probe[start1:start1 + 4, dim2] = [1.0, -1.0, 1.0, -1.0]
+            vec[start2, start1:start1 + 4] = [0.25, -0.25, -0.25, 0.25]
             start1 += 4
             start2 += 1
 
@@ -185,15 +235,21 @@ def sample_theta_space(X, Y, active_dims, msq, lam, eta1, xisq, c, var_obs):
     kX = kappa * X
     kprobe = kappa * probe
 
-    k_xx = kernel(kX, kX, eta1, eta2, c) + var_obs * jnp.eye(N)
-    k_xx_inv = jnp.linalg.inv(k_xx)
-    k_probeX = kernel(kprobe, kX, eta1, eta2, c)
-    k_prbprb = kernel(kprobe, kprobe, eta1, eta2, c)
-
-    mu = jnp.matmul(k_probeX, jnp.matmul(k_xx_inv, Y))
+    # share the Gram computation between the three kernel blocks
+    Q = probe.shape[0]
+    joint = jnp.concatenate([kprobe, kX])
+    k_joint = kernel(joint, joint, eta1, eta2, c)
+    k_prbprb = k_joint[:Q, :Q]
+    k_probeX = k_joint[:Q, Q:]
+    k_xx = jax.ops.index_add(k_joint[Q:, Q:], jnp.diag_indices(N), var_obs)
+    # solve against the Cholesky factor of k_xx and reuse the solve for both
+    # the mean and the covariance
+    k_xx_cho = cho_factor(k_xx, lower=True)
+    S = cho_solve(k_xx_cho, jnp.transpose(k_probeX))
+    mu = jnp.matmul(jnp.transpose(S), Y)
     mu = jnp.sum(mu * vec, axis=-1)
 
-    covar = k_prbprb - jnp.matmul(k_probeX, jnp.matmul(k_xx_inv, jnp.transpose(k_probeX)))
+    covar = k_prbprb - jnp.matmul(k_probeX, S)
     covar = jnp.matmul(vec, jnp.matmul(covar, jnp.transpose(vec)))
     L = jnp.linalg.cholesky(covar)
 
@@ -281,7 +337,8 @@ def main(args):
     samples = run_inference(model, args, rng_key, X, Y, hypers)
 
     # compute the mean and square root variance of each coefficient theta_i
-    means, stds = vmap(lambda dim: analyze_dimension(samples, X, Y, dim, hypers))(jnp.arange(args.num_dimensions))
+    means, stds = chunk_vmap(lambda dim: analyze_dimension(samples, X, Y, dim, hypers),
+                             jnp.arange(args.num_dimensions), chunk_size=args.chunk_size)
 
     print("Coefficients theta_1 to theta_%d used to generate the data:" % args.active_dimensions, expected_thetas)
     print("The single quadratic coefficient theta_{1,2} used to generate the data:", expected_pairwise)
@@ -302,8 +359,9 @@ def main(args):
     # Note that the resulting numbers are only meaningful for i != j.
     if len(active_dimensions) > 0:
         dim_pairs = jnp.array(list(itertools.product(active_dimensions, active_dimensions)))
-        means, stds = vmap(lambda dim_pair: analyze_pair_of_dimensions(samples, X, Y,
-                                                                       dim_pair[0], dim_pair[1], hypers))(dim_pairs)
+        means, stds = chunk_vmap(lambda dim_pair: analyze_pair_of_dimensions(samples, X, Y, dim_pair[0],
+                                                                             dim_pair[1], hypers),
+                                 dim_pairs, chunk_size=args.chunk_size)
         for dim_pair, mean, std in zip(dim_pairs, means, stds):
             dim1, dim2 = dim_pair
             if dim1 >= dim2:
@@ -330,6 +388,8 @@ if __name__ == "__main__":
     parser.add_argument("--num-data", nargs='?', default=100, type=int)
     parser.add_argument("--num-dimensions", nargs='?', default=20, type=int)
     parser.add_argument("--active-dimensions", nargs='?', default=3, type=int)
+    parser.add_argument("--chunk-size", nargs='?', default=10, type=int,
+                        help="number of dimensions (or pairs of dimensions) analyzed at a time")
     parser.add_argument("--device", default='cpu', type=str, help='use "cpu" or "gpu".')
     args = parser.parse_args()
 